@@ -25,15 +25,50 @@
 # USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import argparse
-import copy
-from datetime import datetime
+from array import array
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
 import ftplib
+import hashlib
 import json
 import os
+import queue
+import socket
+import ssl
+from stat import S_ISDIR, S_ISREG
 import sys
+import threading
 import time
+from typing import NamedTuple
+
+# Where the file lists from previous runs are stored.
+CACHE_DIR: str = os.path.join(os.path.expanduser('~'), '.cache', 'ftp-fetch')
+# The size of the buffer each download thread reads the data connection into.
+DOWNLOAD_BLOCK_SIZE: int = 1 << 20
+# How many bytes at the end of a partial download to fetch again when resuming,
+# in case the last block written before the failure is incomplete.
+RESUME_OVERLAP: int = 1024
+# Directories modified less than this many seconds before a file list was saved
+# are always listed again by --dir-mtime, since a change made in the same second
+# wouldn't change the modified date. It also covers the server's clock being
+# slightly off from ours.
+DIR_MTIME_MARGIN: int = 60
+# How many threads scan local directories at the same time. The stat calls
+# release the GIL, so threads overlap the waits on slow or network drives.
+LOCAL_SCAN_THREADS: int = 8
+# How many seconds to wait between sending NOOP on idle connections,
+# short enough to stay under the idle timeout of most servers. Also used
+# for the TCP keepalive probes on the control connections.
+KEEPALIVE_INTERVAL: int = 30
+# The facts to ask for when listing remote directories. `unique` identifies
+# a directory no matter which path it was reached through.
+MLSD_FACTS: list[str] = ['size', 'modify', 'type', 'unique']
+# The types of remote entries that get synced, anything else is skipped.
+ENTRY_TYPES: frozenset = frozenset({'file', 'dir'})
 
 class ConnectionInfo:
+    __slots__ = ('host', 'user', 'pswd', 'tls', 'port', 'timeout')
+
     def __init__(
         self,
         host: str,
@@ -50,36 +85,228 @@ class ConnectionInfo:
         self.port = port
         self.timeout = timeout
 
-class FileInfo:
-    def __init__(
-        self,
-        path: str,
-        m_date: int = 0,
-        size: int = 0,
-        is_dir: bool = False
-    ):
-        self.path = path
-        self.m_date = m_date
-        self.size = int(size)
-        self.is_dir = is_dir
+class FileTable:
+    """
+    A list of files stored as parallel arrays instead of one object per
+    file, which uses a lot less memory on large trees.
+
+    Attributes:
+        idx: A dictionary with the relative path as the key and the row
+            in the arrays as the entry.
+        paths: A list with the full paths.
+        m_dates: An array with the modified dates.
+        sizes: An array with the sizes in bytes.
+        is_dir: A bytearray which is 1 for directories.
+    """
+    __slots__ = ('idx', 'paths', 'm_dates', 'sizes', 'is_dir')
+
+    def __init__(self):
+        self.idx: dict[str, int] = {}
+        self.paths: list[str] = []
+        self.m_dates: array = array('d')
+        self.sizes: array = array('q')
+        self.is_dir: bytearray = bytearray()
+
+    def __len__(self)->int:
+        return len(self.paths)
+
+    def __contains__(self, rel_path: str)->bool:
+        return rel_path in self.idx
+
+    def add(self, rel_path: str, path: str, m_date: float, size: int, is_dir: bool)->None:
+        """ Adds a file to the table, replacing it if it's already there. """
+        i: int|None = self.idx.get(rel_path)
+        if i is not None:
+            self.paths[i] = path
+            self.m_dates[i] = m_date
+            self.sizes[i] = size
+            self.is_dir[i] = is_dir
+            return
+        self.idx[rel_path] = len(self.paths)
+        self.paths.append(path)
+        self.m_dates.append(m_date)
+        self.sizes.append(size)
+        self.is_dir.append(is_dir)
+
+    def row(self, i: int)->tuple:
+        """ Gets the path, modified date, size and is_dir flag stored in row `i`. """
+        return (self.paths[i], self.m_dates[i], self.sizes[i], bool(self.is_dir[i]))
+
+class MLSxEntry(NamedTuple):
+    """ An entry from a MLSD, MLSC or MLST reply, facts the server didn't send are None. """
+    name: str
+    type: str|None
+    size: str|None
+    modify: str|None
+    unique: str|None
+
+class FileRow(NamedTuple):
+    """ The arguments for FileTable.add. """
+    rel_path: str
+    path: str
+    m_date: float
+    size: int
+    is_dir: bool
 
 class SyncInfo:
+    __slots__ = ('remote_root', 'local_root', 'blacklist', 'whitelist')
+
     def __init__(
         self,
         remote_root: str = '',
         local_root: str = '',
-        blacklist: list = [],
-        whitelist: list = [],
+        blacklist: list|None = None,
+        whitelist: list|None = None,
     ):
         self.remote_root = remote_root
         self.local_root = local_root
-        self.blacklist = blacklist
-        self.whitelist = whitelist
+        # Stored as a frozenset since it's only used to check if paths are blacklisted.
+        self.blacklist = frozenset(blacklist or ())
+        # Copied so changing the list that was passed in doesn't change the sync.
+        self.whitelist = list(whitelist) if whitelist else []
+
+class TransferTypeMixin:
+    """
+    Remembers which transfer type the connection is using so switching to the
+    type it's already in doesn't cost a round trip to the server.
+    ftplib.FTP.retrbinary sends `TYPE I` before every download otherwise.
+    """
+    transfer_type: str = ''
+
+    def sendcmd(self, cmd: str)->str:
+        resp: str = super().sendcmd(cmd)
+        if cmd.upper().startswith('TYPE '):
+            self.transfer_type = cmd[5:].upper()
+        return resp
+
+    def voidcmd(self, cmd: str)->str:
+        if cmd.upper().startswith('TYPE '):
+            if cmd[5:].upper() == self.transfer_type:
+                return f'200 Type already set to {self.transfer_type}'
+            resp: str = super().voidcmd(cmd)
+            self.transfer_type = cmd[5:].upper()
+            return resp
+        return super().voidcmd(cmd)
+
+class MLSTFactsMixin:
+    """
+    Remembers which facts the server was last asked to include in MLSD and MLST
+    replies, so each connection only sends `OPTS MLST` once instead of before
+    every listing.
+    """
+    mlst_facts: str = ''
+
+    def sendcmd(self, cmd: str)->str:
+        if not cmd.upper().startswith('OPTS MLST '):
+            return super().sendcmd(cmd)
+        if cmd[10:].lower() == self.mlst_facts:
+            return f'200 MLST OPTS {self.mlst_facts}'
+        resp: str = super().sendcmd(cmd)
+        self.mlst_facts = cmd[10:].lower()
+        return resp
+
+class ControlSocketMixin:
+    """
+    Tunes the control connection once it's open. TCP keepalive stops firewalls and
+    NAT routers from dropping it while it sits unused during a long download, and
+    disabling Nagle's algorithm stops small commands from being held back.
+    """
+    def connect(self, *args, **kwargs)->str:
+        resp: str = super().connect(*args, **kwargs)
+        sock: socket.socket = self.sock
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # How long the connection is idle before the first probe and the time
+            # between probes aren't available on every system.
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_INTERVAL)
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        except OSError:
+            # The connection still works without them.
+            pass
+        return resp
+
+class PipelinedTransferMixin:
+    """
+    Sends the transfer command before opening a passive data connection instead
+    of after, so the server's reply and the TCP handshake share a round trip.
+    Falls back to the order ftplib uses for the rest of the session if the server
+    can't accept the data connection that way.
+    """
+    pipeline_transfers: bool = True
+
+    def open_data_connection(self, cmd: str, rest=None)->tuple:
+        """ Opens a data connection like ftplib.FTP.ntransfercmd, without any TLS. """
+        if not (self.passiveserver and self.pipeline_transfers):
+            return ftplib.FTP.ntransfercmd(self, cmd, rest)
+        host, port = self.makepasv()
+        if rest is not None:
+            self.sendcmd(f'REST {rest}')
+        self.putcmd(cmd)
+        conn: socket.socket = socket.create_connection((host, port), self.timeout, source_address=self.source_address)
+        try:
+            resp: str = self.getresp()
+            # Some servers send a 2xx reply before the 1xx one, see ftplib.FTP.ntransfercmd.
+            if resp[0] == '2':
+                resp = self.getresp()
+            if resp[0] != '1':
+                raise ftplib.error_reply(resp)
+        except ftplib.error_temp as e:
+            conn.close()
+            if not str(e).startswith('425'):
+                raise
+            # The server wanted the connection before the command, use the usual order from now on.
+            self.pipeline_transfers = False
+            return ftplib.FTP.ntransfercmd(self, cmd, rest)
+        except:
+            conn.close()
+            raise
+        return conn, ftplib.parse150(resp) if resp[:3] == '150' else None
+
+    def ntransfercmd(self, cmd: str, rest=None)->tuple:
+        return self.open_data_connection(cmd, rest)
+
+class TLSSessionMixin:
+    """
+    Reuses the TLS session of the control connection on every data connection,
+    so each listing and download only needs an abbreviated handshake.
+    Some servers also refuse data connections that don't reuse the session.
+    Needs PipelinedTransferMixin for opening the connection itself.
+    """
+    def ntransfercmd(self, cmd: str, rest=None)->tuple:
+        # ftplib.FTP_TLS.ntransfercmd wraps the socket without a session, so skip it.
+        conn, size = self.open_data_connection(cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+        return conn, size
+
+class FetchFTP(TransferTypeMixin, MLSTFactsMixin, ControlSocketMixin, PipelinedTransferMixin, ftplib.FTP):
+    pass
+
+class FetchFTP_TLS(TransferTypeMixin, MLSTFactsMixin, ControlSocketMixin, TLSSessionMixin, PipelinedTransferMixin, ftplib.FTP_TLS):
+    pass
 
 def is_windows()->bool:
     """ Check if the current system is Windows. """
     return True if os.name == 'nt' else False
 
+def get_leaf_dirs(dirs: list[str])->list[str]:
+    """
+    Gets the directories that don't have any of the other directories inside them.
+
+    Arguments:
+        dirs: A list of relative directory paths.
+
+    Returns:
+        A list with the deepest directories, creating them with os.makedirs
+        creates every directory in `dirs`.
+    """
+    # Sorting by path components puts each directory right before its children.
+    ordered: list[str] = sorted(dirs, key=lambda d: d.split('/'))
+    return [d for d, nxt in zip(ordered, ordered[1:] + ['']) if not nxt.startswith(d + '/')]
+
 def get_dir_level(path: str)->int:
     """
     Get how many directories deep the path is
@@ -95,10 +322,7 @@ def write_summary(text: str, path: str)->None:
 
 def format_list_to_str(l: list)->str:
     """ Output each list item on a new line in alphabetical order. """
-    output: str = ""
-    for i in sorted(l):
-        output += f"\n{i}"
-    return output
+    return ''.join([f"\n{i}" for i in sorted(l)])
 
 def standardize_slashes(path: str, beginning_slash: bool = True)->str:
     """
@@ -119,37 +343,136 @@ def standardize_slashes(path: str, beginning_slash: bool = True)->str:
         path = ('' if path[:1] == '/' else '/') + path
     return path.rsplit('/', 1)[0] if path[-1] == '/' else path
 
-def generate_fileinfo_for_remote_files(sync_info: SyncInfo, parent_path: str, mlsd_info: list, v: bool = False)->tuple|None:
+def get_cache_path(name: str, sync_info: SyncInfo)->str:
     """
-    Creates a FileInfo object for remote files.
+    Gets the path of the cache file for a file list.
+
+    Arguments:
+        name: A string identifying the files being cached, such as the host and root directory.
+        sync_info: A SyncInfo object, the whitelist and blacklist are part of the
+            key since they change which files get listed.
+
+    Returns:
+        A string with the path to the cache file.
+    """
+    key: str = '|'.join([name, ','.join(sync_info.whitelist), ','.join(sorted(sync_info.blacklist))])
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+def load_file_cache(path: str, ttl: int, root_m_date, stale: bool = False)->FileTable|None:
+    """
+    Loads a file list saved by a previous run.
+
+    Arguments:
+        path: A string with the path to the cache file.
+        ttl: How many seconds a cached file list stays valid for.
+        root_m_date: The current modified date of the root directory, the cache is
+            only used if it hasn't changed since the file list was saved.
+        stale: Load the file list even if it's expired or the root directory has changed.
+            Directories modified within DIR_MTIME_MARGIN seconds of the list being
+            saved get a modified date of -1, so they never look unchanged.
+
+    Returns:
+        None if there's no usable cache, otherwise a FileTable object.
+    """
+    if root_m_date is None:
+        return None
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if not stale and (time.time() - data['time'] >= ttl or data['root_m_date'] != root_m_date):
+            return None
+        # The columns are stored separately, the same way FileTable stores them.
+        files = FileTable()
+        files.idx = {key: i for i, key in enumerate(data['files']['keys'])}
+        files.paths = data['files']['paths']
+        files.m_dates = array('d', data['files']['m_dates'])
+        files.sizes = array('q', data['files']['sizes'])
+        files.is_dir = bytearray(data['files']['is_dir'])
+        if stale:
+            recent: float = data['time'] - DIR_MTIME_MARGIN
+            for i, m_date in enumerate(files.m_dates):
+                if m_date > recent and files.is_dir[i]:
+                    files.m_dates[i] = -1
+    except Exception:
+        # A missing, old or damaged cache just means the files get listed again.
+        return None
+    return files
+
+def save_file_cache(path: str, files: FileTable, root_m_date)->None:
+    """
+    Saves a file list so it can be reused by the next run.
+
+    Arguments:
+        path: A string with the path to the cache file.
+        files: A FileTable object.
+        root_m_date: The current modified date of the root directory.
+    """
+    if root_m_date is None:
+        return
+    data: dict = {
+        'time': time.time(),
+        'root_m_date': root_m_date,
+        'files': {
+            'keys': list(files.idx),
+            'paths': files.paths,
+            'm_dates': files.m_dates.tolist(),
+            'sizes': files.sizes.tolist(),
+            'is_dir': list(files.is_dir),
+        }
+    }
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so a cache is never left half written.
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"WARNING: Couldn't save the file list cache to {path}: {e}")
+
+def parse_mlsd_time(s: str)->int:
+    """
+    Converts the value of a `modify` fact to a timestamp.
+
+    Arguments:
+        s: A string in the format YYYYMMDDHHMMSS, in UTC. Fractions of a second
+            after it are ignored.
+
+    Returns:
+        The timestamp in seconds.
+    """
+    # The format never changes so slicing it is much faster than using strptime.
+    return timegm((int(s[0:4]), int(s[4:6]), int(s[6:8]), int(s[8:10]), int(s[10:12]), int(s[12:14]), 0, 0, 0))
+
+def generate_fileinfo_for_remote_files(root_len: int, blacklist: frozenset, parent_path: str, mlsd_info: MLSxEntry, v: bool = False)->FileRow|None:
+    """
+    Creates the file info for remote files.
 
     Args:
-        sync_info: A SyncInfo object.
+        root_len: The length of the remote root, used to find the relative path.
+        blacklist: A frozenset with the relative paths to skip.
         parent_path: A string containing the parent directory of the current path.
-        mlsd_info: A list with the results of the MSLD command.
+        mlsd_info: A MLSxEntry from the MLSD command, as returned by parse_mlsx_entry.
         v: A bool indicating if more info should be outputed to the console.
 
     Returns:
-        None if the path doesn't exist or is blacklisted, otherwise returns a tuple
-        where the first element is the path relative to the root directory and the
-        second element is a FileInfo object.
+        None if the path doesn't exist or is blacklisted, otherwise returns a FileRow
+        with the arguments for FileTable.add.
     """
-    path: str = f"{parent_path}/{mlsd_info[0]}"
-    # Remote the root path since the local and remote roots are usually different.
-    rel_path: str = path.replace(sync_info.remote_root, '')
-    f_info: dict = mlsd_info[1]
+    path: str = f"{parent_path}/{mlsd_info.name}"
+    # Remove the root path since the local and remote roots are usually different.
+    # Every path starts with the root so it can just be sliced off.
+    rel_path: str = path[root_len:]
+    entry_type: str|None = mlsd_info.type
 
     # Return None if the entry is not a normal file or directory or if it's blacklisted.
-    if (f_info['type'] not in {'file', 'dir'}) or (rel_path in sync_info.blacklist):
+    if (entry_type not in ENTRY_TYPES) or (rel_path in blacklist):
         return None
 
     if v: print(f"Found: {rel_path}")
-    is_dir: bool = True if 'dir' == f_info['type'] else False
+    is_dir: bool = True if 'dir' == entry_type else False
 
-    # Find the modified date.
-    m_date = time.mktime(datetime.strptime(str(f_info['modify']), '%Y%m%d%H%M%S').timetuple())
-    # Return a filled out FileInfo object.
-    return (rel_path, FileInfo(path, m_date, f_info.get('size', 0), is_dir))
+    # Return the filled out file info.
+    return FileRow(rel_path, path, parse_mlsd_time(mlsd_info.modify), int(mlsd_info.size or 0), is_dir)
 
 def load_connection_settings(args)->tuple:
     """
@@ -164,19 +487,18 @@ def load_connection_settings(args)->tuple:
         settings specified in the commandline and config file.
     """
     path: str = args.connection_json
+    # Make sure the file is a json file.
+    if not path.endswith('.json'):
+        print('File is not of type: JSON')
+        print(f'Failed to open file: {path}')
+        sys.exit()
     try:
-        # Make sure the file is a json file.
-        if path.rsplit('.', 1)[1] != 'json':
-            print('File is not of type: JSON')
-            raise Exception()
-        f = open(path, 'r')
-        data = json.load(f)
-    except:
+        # json.loads accepts bytes, so the file doesn't need a text wrapper.
+        with open(path, 'rb') as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError):
         print(f'Failed to open file: {path}')
         sys.exit()
-    finally:
-        if 'f' in locals():
-            f.close()
 
     # Apply commandline overrides for the whitelist and blacklist.
     if args.blacklist:
@@ -188,6 +510,20 @@ def load_connection_settings(args)->tuple:
         whitelist = [standardize_slashes(entry) for entry in args.whitelist.split(',')]
     else:
         whitelist = [standardize_slashes(entry) for entry in data['whitelist']]
+    # Drop duplicates and entries inside another whitelisted directory,
+    # they'd be listed a second time when the parent is scanned.
+    whitelist_prefixes: tuple = tuple(entry + '/' for entry in whitelist if entry)
+    whitelist = [entry for entry in dict.fromkeys(whitelist) if not entry.startswith(whitelist_prefixes)]
+    # Drop entries that are blacklisted or inside a blacklisted directory, the
+    # scans would otherwise start inside a tree that's meant to be skipped.
+    if whitelist:
+        blacklist_prefixes: tuple = tuple(entry + '/' for entry in blacklist if entry)
+        blacklisted: set = set(blacklist)
+        whitelist = [entry for entry in whitelist if entry not in blacklisted and not entry.startswith(blacklist_prefixes)]
+        # An empty whitelist means everything gets synced, which isn't what was asked for.
+        if not whitelist:
+            print('Every whitelist entry is blacklisted, there is nothing to sync.')
+            sys.exit()
 
     rc_data = data['remote_connection']
     return (
@@ -217,23 +553,23 @@ def connect(con_info: ConnectionInfo)->ftplib.FTP:
     Returns:
         A ftplib.FTP object connected to the server.
     """
-    ftp: ftplib.FTP = ftplib.FTP_TLS() if (con_info.tls) else ftplib.FTP()
+    ftp: ftplib.FTP = FetchFTP_TLS() if (con_info.tls) else FetchFTP()
     ftp.set_debuglevel(0)
     print(f'Connecting to {con_info.host} on port {con_info.port}...')
 
     try:
         ftp.connect(con_info.host, con_info.port, con_info.timeout)
         print('Connection successful!')
-    except:
-        print('Connection Failed!\nPlease make sure your settings are correct and the server is running.')
+    except ftplib.all_errors as e:
+        print(f'Connection Failed! ({e})\nPlease make sure your settings are correct and the server is running.')
         sys.exit()
 
     print(f'Logging in as {con_info.user} with the provided password...')
     try:
         ftp.login(con_info.user, con_info.pswd)
         print('Login successful!')
-    except:
-        print('Login failed!\nPlease make sure the login details are correct.')
+    except ftplib.all_errors as e:
+        print(f'Login failed! ({e})\nPlease make sure the login details are correct.')
         sys.exit()
 
     if con_info.tls:
@@ -241,82 +577,688 @@ def connect(con_info: ConnectionInfo)->ftplib.FTP:
 
     return ftp
 
-def get_remote_files(ftp: ftplib.FTP, sync_info: SyncInfo, v: bool)->dict[str, FileInfo]:
+def open_connection(con_info: ConnectionInfo)->ftplib.FTP:
+    """
+    Opens an additional connection to the FTP server without any console output.
+
+    Arguments:
+        con_info: A ConnectionInfo object.
+
+    Returns:
+        A ftplib.FTP object connected and logged in to the server.
+
+    Raises:
+        Any of ftplib.all_errors if connecting or logging in fails.
+    """
+    ftp: ftplib.FTP = FetchFTP_TLS() if (con_info.tls) else FetchFTP()
+    ftp.connect(con_info.host, con_info.port, con_info.timeout)
+    ftp.login(con_info.user, con_info.pswd)
+    if con_info.tls:
+        ftp.prot_p()
+    return ftp
+
+def get_features(ftp: ftplib.FTP)->set[str]:
+    """
+    Gets the extra commands the server supports using FEAT.
+
+    Arguments:
+        ftp: A ftplib.FTP object connected to the server.
+
+    Returns:
+        A set with the names of the supported features in upper case, or an
+        empty set if the server doesn't support FEAT.
+    """
+    try:
+        resp: str = ftp.sendcmd('FEAT')
+    except ftplib.error_perm:
+        return set()
+    # The first and last lines are the start and end of the reply,
+    # every line in between is a feature.
+    return {line.split()[0].upper() for line in resp.splitlines()[1:-1] if line.strip()}
+
+def parse_mlsx_line(line: str)->tuple:
+    """
+    Parses a line returned by MLSD, MLSC or MLST the same way ftplib.FTP.mlsd does.
+
+    Arguments:
+        line: A string in the format `fact=value;fact=value; name`.
+
+    Returns:
+        A tuple where the first element is the name and the second is a
+        dictionary of facts with lower case keys.
+    """
+    facts_found, _, name = line.partition(' ')
+    facts: dict = {}
+    for fact in facts_found[:-1].split(';'):
+        key, _, value = fact.partition('=')
+        facts[key.lower()] = value
+    return (name, facts)
+
+def find_fact(facts: str, lower_facts: str, key: str)->str|None:
+    """
+    Finds the value of a single fact in the facts part of a MLSD line.
+
+    Arguments:
+        facts: A string with the facts, starting with a semicolon.
+        lower_facts: The same string in lower case, since fact names aren't case sensitive.
+        key: The lower case name of the fact surrounded by `;` and `=`, such as `;size=`.
+
+    Returns:
+        A string with the value of the fact, or None if it isn't there.
+    """
+    start: int = lower_facts.find(key)
+    if start < 0:
+        return None
+    start += len(key)
+    end: int = facts.find(';', start)
+    return facts[start:] if end < 0 else facts[start:end]
+
+def parse_mlsx_entry(line: str)->MLSxEntry:
+    """
+    Parses a line returned by MLSD or MLSC, only reading the facts that are used
+    instead of building a dictionary of every fact.
+
+    Arguments:
+        line: A string in the format `fact=value;fact=value; name`.
+
+    Returns:
+        A MLSxEntry with the name, type, size, modified date and unique id of the
+        entry. The type is in lower case, and the other facts are only read if the
+        type is in ENTRY_TYPES.
+    """
+    facts, _, name = line.partition(' ')
+    # The leading semicolon means every fact, including the first, can be found with ';name='.
+    facts = ';' + facts
+    lower_facts: str = facts.lower()
+    entry_type: str|None = find_fact(facts, lower_facts, ';type=')
+    if entry_type is not None:
+        entry_type = entry_type.lower()
+    if entry_type not in ENTRY_TYPES:
+        return MLSxEntry(name, entry_type, None, None, None)
+    return MLSxEntry(
+        name,
+        entry_type,
+        find_fact(facts, lower_facts, ';size='),
+        find_fact(facts, lower_facts, ';modify='),
+        find_fact(facts, lower_facts, ';unique=')
+    )
+
+def mlsd(ftp: ftplib.FTP, path: str, facts: list)->list:
+    """
+    Lists a directory with MLSD.
+
+    Arguments:
+        ftp: A ftplib.FTP object connected to the server.
+        path: A string with the path of the directory to list.
+        facts: A list of the facts the server should include.
+
+    Returns:
+        A list of MLSxEntry objects, as returned by parse_mlsx_entry.
+    """
+    ftp.sendcmd('OPTS MLST ' + ''.join(f"{fact};" for fact in facts))
+    # Read the whole listing first so the data connection is closed as soon as possible.
+    lines: list[str] = []
+    ftp.retrlines(f'MLSD {path}'.strip(), lines.append)
+    return [parse_mlsx_entry(line) for line in lines]
+
+def mlsc(ftp: ftplib.FTP, path: str, facts: list)->list:
+    """
+    Lists a directory with MLSC, which sends the listing back over the
+    control connection instead of opening a data connection like MLSD.
+
+    Arguments:
+        ftp: A ftplib.FTP object connected to a server that supports MLSC.
+        path: A string with the path of the directory to list.
+        facts: A list of the facts the server should include.
+
+    Returns:
+        A list of MLSxEntry objects, as returned by parse_mlsx_entry.
+    """
+    ftp.sendcmd('OPTS MLST ' + ''.join(f"{fact};" for fact in facts))
+    resp: str = ftp.sendcmd(f'MLSC {path}'.strip())
+    # Entries are the lines between the start and end of the reply,
+    # each one starts with a space.
+    return [parse_mlsx_entry(line[1:]) for line in resp.splitlines()[1:-1] if line[:1] == ' ']
+
+def mlst(ftp: ftplib.FTP, path: str, facts: list)->dict:
+    """
+    Gets the facts for a single remote path using MLST.
+
+    Arguments:
+        ftp: A ftplib.FTP object connected to the server.
+        path: A string with the remote path.
+        facts: A list of the facts the server should include.
+
+    Returns:
+        A dictionary of facts with lower case keys.
+
+    Raises:
+        ftplib.error_perm if the path doesn't exist or the server doesn't support MLST.
+    """
+    # The reply uses whichever facts the connection was last asked for,
+    # which are the server's defaults on a new connection.
+    ftp.sendcmd('OPTS MLST ' + ''.join(f"{fact};" for fact in facts))
+    resp: str = ftp.sendcmd(f'MLST {path}'.strip())
+    # The entry is on the line after the start of the reply, after a leading space.
+    lines: list = resp.splitlines()
+    if len(lines) < 3:
+        raise ftplib.error_reply(resp)
+    return parse_mlsx_line(lines[1][1:])[1]
+
+class ConnectionPool:
+    """
+    A pool of connections to the FTP server that can be shared between threads.
+
+    Arguments:
+        ftp: A ftplib.FTP object that's already connected, it becomes the first
+            connection in the pool.
+        con_info: A ConnectionInfo object used to open the other connections.
+        size: How many connections the pool should have. If the server refuses
+            some of them the pool will be smaller.
+    """
+    def __init__(self, ftp: ftplib.FTP, con_info: ConnectionInfo, size: int):
+        self.con_info = con_info
+        self.features: set[str] = get_features(ftp)
+        self._queue: queue.Queue = queue.Queue()
+        self._queue.put(ftp)
+        for _ in range(size - 1):
+            try:
+                self._queue.put(open_connection(con_info))
+            except ftplib.all_errors as e:
+                print(f"WARNING: Couldn't open another connection ({e}), continuing with {self._queue.qsize()}.")
+                break
+        self.size = self._queue.qsize()
+        # One thread per connection, shared by everything that uses the pool.
+        self._executor = ThreadPoolExecutor(max_workers=self.size)
+        # Keep idle connections from timing out, such as while waiting for
+        # confirmation or scanning the local files.
+        self._stop = threading.Event()
+        self._keepalive = threading.Thread(target=self._keep_alive, daemon=True)
+        self._keepalive.start()
+
+    def _keep_alive(self)->None:
+        """ Sends NOOP on every idle connection each KEEPALIVE_INTERVAL seconds until the pool is closed. """
+        while not self._stop.wait(KEEPALIVE_INTERVAL):
+            # Take every idle connection at once so none of them gets sent NOOP twice.
+            idle: list = []
+            while True:
+                try:
+                    idle.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for ftp in idle:
+                if ftp is None:
+                    self._queue.put(None)
+                    continue
+                try:
+                    ftp.voidcmd('NOOP')
+                    self._queue.put(ftp)
+                except ftplib.all_errors:
+                    self.drop(ftp)
+
+    def map(self, func, items)->list:
+        """ Runs `func` on every item using the pool's threads and returns the results in order. """
+        return list(self._executor.map(func, items))
+
+    def get(self)->ftplib.FTP:
+        """ Waits for a free connection, replacing it first if it was dropped. """
+        ftp: ftplib.FTP|None = self._queue.get()
+        if ftp is None:
+            try:
+                ftp = open_connection(self.con_info)
+            except:
+                self._queue.put(None)
+                raise
+        return ftp
+
+    def put(self, ftp: ftplib.FTP)->None:
+        """ Gives a connection back to the pool once it's finished being used. """
+        self._queue.put(ftp)
+
+    def drop(self, ftp: ftplib.FTP)->None:
+        """ Closes a broken connection, it'll be reopened the next time it's needed. """
+        ftp.close()
+        self._queue.put(None)
+
+    def close(self)->None:
+        """ Closes every connection in the pool. """
+        self._stop.set()
+        self._keepalive.join()
+        self._executor.shutdown()
+        while not self._queue.empty():
+            ftp: ftplib.FTP|None = self._queue.get_nowait()
+            if ftp is None:
+                continue
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+def list_remote_dir(pool: ConnectionPool, path: str)->tuple:
+    """
+    Lists a remote directory using one of the pool's connections.
+
+    Arguments:
+        pool: A ConnectionPool object.
+        path: A string with the path of the directory to list.
+
+    Returns:
+        A tuple where the first element is `path` and the second is a list
+        of MLSxEntry objects, as returned by parse_mlsx_entry.
+    """
+    ftp: ftplib.FTP = pool.get()
+    try:
+        if 'MLSC' in pool.features:
+            entries: list = mlsc(ftp, path, MLSD_FACTS)
+        else:
+            entries = mlsd(ftp, path, MLSD_FACTS)
+    except ftplib.error_perm:
+        pool.put(ftp)
+        raise
+    except:
+        pool.drop(ftp)
+        raise
+    pool.put(ftp)
+    return (path, entries)
+
+# A buffer for each download thread, reused for every block of every file.
+download_buffers = threading.local()
+
+class LocalWriteError(OSError):
+    """ The local file couldn't be written to during a download, the connection is still usable. """
+
+def retrieve_file(ftp: ftplib.FTP, cmd: str, fd: int, rest=None)->str:
+    """
+    Downloads a file the same way as ftplib.FTP.retrbinary, except each block is
+    read into a reused buffer and written straight to the file instead of a new
+    bytes object being created and passed to a callback for every block.
+
+    Arguments:
+        ftp: A ftplib.FTP object connected to the server.
+        cmd: A string with the RETR command.
+        fd: The file descriptor to write to.
+        rest: The offset to start the download from, or None for the whole file.
+
+    Returns:
+        A string with the server's reply once the transfer is complete.
+
+    Raises:
+        LocalWriteError if writing to `fd` fails. The transfer is stopped and the
+        server's reply is read first, so the connection can be used again.
+    """
+    buf: bytearray|None = getattr(download_buffers, 'buf', None)
+    if buf is None:
+        buf = download_buffers.buf = bytearray(DOWNLOAD_BLOCK_SIZE)
+    view = memoryview(buf)
+    ftp.voidcmd('TYPE I')
+    error: OSError|None = None
+    with ftp.transfercmd(cmd, rest) as conn:
+        while n := conn.recv_into(buf):
+            # os.write can write less than it's given.
+            written: int = 0
+            try:
+                while written < n:
+                    written += os.write(fd, view[written:n])
+            except OSError as e:
+                error = e
+                break
+        # Close the TLS layer properly so the server knows the file wasn't cut off.
+        if error is None and isinstance(conn, ssl.SSLSocket):
+            conn.unwrap()
+    if error is not None:
+        try:
+            ftp.getresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            # The server reports the transfer as aborted since it was cut off.
+            pass
+        raise LocalWriteError(*error.args) from error
+    return ftp.voidresp()
+
+def get_part_path(path: str, m_date: float, size: int)->str:
+    """
+    Gets the path a file is downloaded to before it's complete. The modified date
+    and size of the remote file are part of the name, so a partial download left
+    by a run that was killed is only continued if the remote file hasn't changed.
+
+    Arguments:
+        path: A string with the path the file is being downloaded to.
+        m_date: The modified date of the remote file.
+        size: The size of the remote file in bytes.
+
+    Returns:
+        A string in the format `<path>.<m_date>-<size>.part`.
+    """
+    return f"{path}.{int(m_date)}-{size}.part"
+
+def resume_download(pool: ConnectionPool, r_path: str, path: str, m_date: float, size: int, attempts: int = 3)->None:
+    """
+    Downloads a file to the path from get_part_path and moves it into place once it's complete.
+    If a transfer fails, the next attempt continues from where the last one stopped
+    using REST instead of starting over, including attempts made by later runs.
+
+    Arguments:
+        pool: A ConnectionPool object.
+        r_path: A string with the path of the file on the remote server.
+        path: A string with the local path to download the file to.
+        m_date: The modified date of the remote file.
+        size: The size of the remote file in bytes.
+        attempts: How many times to try the download before giving up.
+
+    Raises:
+        The error from the last attempt if every attempt fails. Errors with the local
+        file, such as a full disk, are raised straight away without trying again.
+    """
+    part_path: str = get_part_path(path, m_date, size)
+    use_rest: bool = True
+    for attempt in range(attempts):
+        offset: int = 0
+        # The name only matches a partial file from the same version of the remote file.
+        if use_rest and os.path.exists(part_path):
+            part_size: int = os.stat(part_path).st_size
+            if part_size <= size:
+                offset = max(0, part_size - RESUME_OVERLAP)
+
+        # The local file is set up before taking a connection, so an error
+        # here doesn't cost one.
+        with open(part_path, 'r+b' if offset else 'wb', buffering=0) as open_file:
+            open_file.seek(offset)
+            open_file.truncate()
+            ftp: ftplib.FTP = pool.get()
+            try:
+                retrieve_file(ftp, f"RETR {r_path}", open_file.fileno(), offset or None)
+            except ftplib.error_perm:
+                # The connection is fine, but the server refused the file or the REST command.
+                pool.put(ftp)
+                if not offset or attempt == attempts - 1:
+                    raise
+                use_rest = False
+                continue
+            except LocalWriteError:
+                # The connection is fine, trying again wouldn't help the local file.
+                pool.put(ftp)
+                raise
+            except ftplib.all_errors:
+                # Drop the connection instead of giving a broken one to the next download.
+                pool.drop(ftp)
+                if attempt == attempts - 1:
+                    raise
+                continue
+            pool.put(ftp)
+        os.replace(part_path, path)
+        return
+
+def find_remote_entry(pool: ConnectionPool, path: str)->tuple|None:
+    """
+    Finds a single remote file or directory. Uses MLST if the server supports it,
+    otherwise the parent directory is listed and searched for the entry.
+
+    Arguments:
+        pool: A ConnectionPool object.
+        path: A string with the full remote path.
+
+    Returns:
+        None if the path doesn't exist, otherwise a tuple where the first element
+        is the path of the parent directory and the second is a MLSxEntry.
+
+    Raises:
+        Any other error from the server, since treating a failed lookup as a
+        missing path would get the local copy deleted.
+    """
+    parent_path, name = path.rsplit('/', 1)
+    if 'MLST' in pool.features:
+        ftp: ftplib.FTP = pool.get()
+        try:
+            facts: dict = mlst(ftp, path, MLSD_FACTS)
+        except ftplib.error_perm as e:
+            # The connection is fine, the server just refused the command.
+            pool.put(ftp)
+            if str(e)[:3] == '550':
+                return None
+            raise
+        except:
+            pool.drop(ftp)
+            raise
+        pool.put(ftp)
+        entry_type: str|None = facts.get('type')
+        return (parent_path, MLSxEntry(
+            name,
+            entry_type and entry_type.lower(),
+            facts.get('size'),
+            facts.get('modify'),
+            facts.get('unique')
+        ))
+
+    try:
+        # Get the children of the parent directory.
+        parent_path_children = list_remote_dir(pool, parent_path)[1]
+    except ftplib.error_perm as e:
+        if str(e)[:3] == '550':
+            return None
+        raise
+    for f in parent_path_children:
+        if f.name == name:
+            return (parent_path, f)
+    return None
+
+def get_remote_m_date(pool: ConnectionPool, path: str)->str|None:
+    """
+    Gets the modified date of a single remote path using MLST.
+
+    Arguments:
+        pool: A ConnectionPool object.
+        path: A string with the remote path.
+
+    Returns:
+        A string with the value of the `modify` fact, or None if it couldn't be found
+        or the server doesn't support MLST.
+    """
+    if 'MLST' not in pool.features:
+        return None
+    ftp: ftplib.FTP = pool.get()
+    try:
+        facts: dict = mlst(ftp, path, MLSD_FACTS)
+    except (ftplib.error_perm, ftplib.error_reply):
+        # The connection is fine, the server just couldn't give the date.
+        pool.put(ftp)
+        return None
+    except ftplib.all_errors:
+        # Drop the connection instead of giving a broken one to the next listing.
+        pool.drop(ftp)
+        return None
+    pool.put(ftp)
+    return facts.get('modify')
+
+def get_local_m_date(path: str)->float|None:
+    """ Gets the modified date of a local path, or None if it doesn't exist. """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def get_remote_files(pool: ConnectionPool, sync_info: SyncInfo, v: bool, previous: FileTable|None = None)->FileTable:
     """
     Gets a list of all files on the remote server that exist in whitelisted paths.
 
     Arguments:
-        ftp: A ftplib.FTP object connected to the remote server.
+        pool: A ConnectionPool object connected to the remote server.
         sync_info: A SyncInfo object.
         v: A boolean indicating whether or not to display additional information.
+        previous: A FileTable from an earlier run. Directories whose modified date
+            hasn't changed since then aren't listed again, the files in them are
+            copied from `previous` and only their subdirectories are looked up.
+            Needs a server that supports MLST.
 
     Returns:
-        dict[str, FileInfo] A dictionary with the file path as the key and a FileInfo object
-        as the entry.
+        FileTable A table of the files keyed by the path relative to the root directory.
     """
-    files: dict[str, FileInfo] = {}
-    scan_list: list = [sync_info.remote_root]
+    files: FileTable = FileTable()
+    root: str = sync_info.remote_root
+    root_len: int = len(root)
+    blacklist: frozenset = sync_info.blacklist
+    scan_list: list = [root]
+    # Subdirectories of unchanged directories, looked up with MLST instead of being listed.
+    check_list: list = []
     print('Getting remote files...')
 
+    # The keys and rows of `previous` grouped by the relative path of their parent directory.
+    children: dict[str, list[tuple]] = {}
+    if previous is not None:
+        for key, i in previous.idx.items():
+            children.setdefault(key.rsplit('/', 1)[0], []).append((key, i))
+    # The unique id of every directory found, keyed by its full path.
+    uniques: dict[str, str] = {}
+
+    def add_entry(file_info: FileRow, unique: str|None, next_level: list, next_check: list)->None:
+        files.add(*file_info)
+        if not file_info.is_dir:
+            return
+        if unique:
+            # A directory with the same unique id as one of its parents is a symbolic
+            # link looping back up the tree, so scanning it would never end. Links to
+            # anywhere else are still scanned, leaving them out would get the local
+            # copies of their files deleted.
+            parent: str = file_info.path
+            while '/' in parent:
+                parent = parent.rsplit('/', 1)[0]
+                if uniques.get(parent) == unique:
+                    return
+            uniques[file_info.path] = unique
+        rel_path: str = file_info.rel_path
+        i: int|None = previous.idx.get(rel_path) if previous is not None else None
+        if i is None or not previous.is_dir[i] or previous.m_dates[i] != file_info.m_date:
+            next_level.append(file_info.path)
+            return
+        # Nothing was added, removed or renamed in the directory since the last run.
+        if v: print(f"Unchanged directory: {file_info.path}")
+        for key, j in children.get(rel_path, ()):
+            if previous.is_dir[j]:
+                next_check.append(previous.paths[j])
+            else:
+                files.add(key, *previous.row(j))
+
     if sync_info.whitelist:
         scan_list = []
-        # Only add whitelist entries if they exist.
-        for d in sync_info.whitelist:
-            path: str = sync_info.remote_root + d
-            split_path: list = path.rsplit('/', 1)
-            try:
-                # Get the children of the parent directory.
-                parent_path_children = ftp.mlsd(split_path[0], facts=['size', 'modify', 'type'])
-            except:
-                print(f"WARNING: {path} doesn't exist on the remote server!")
+        # Only add whitelist entries if they exist, every entry is looked up at the same time.
+        found: list = pool.map(lambda d: find_remote_entry(pool, root + d), sync_info.whitelist)
+        for d, found_entry in zip(sync_info.whitelist, found):
+            if found_entry is None:
+                print(f"WARNING: {root + d} doesn't exist on the remote server!")
                 continue
-            # Check if the whitelisted path exists.
-            for f in parent_path_children:
-                if f[0] != split_path[1]:
-                    continue
 
-                file_info = generate_fileinfo_for_remote_files(sync_info, split_path[0], f, False)
-                if not file_info:
-                    continue
-                # Add the entry to the scan list if it's a directory.
-                if file_info[1].is_dir:
-                    scan_list.append(path)
-                # Add whitelist entry to the file list.
-                files[file_info[0]] = file_info[1]
-
-    for d in scan_list:
-        if v: print(f"Changing directory to: {d}")
-
-        # Get the files in the directory.
-        dir_files = ftp.mlsd(d, facts=['size', 'modify', 'type'])
-        for f in dir_files:
-            file_info = generate_fileinfo_for_remote_files(sync_info, d, f, v)
+            parent_path, entry = found_entry
+            file_info = generate_fileinfo_for_remote_files(root_len, blacklist, parent_path, entry, False)
             if not file_info:
                 continue
-            # Add the entry to the scan list if it's a directory.
-            if file_info[1].is_dir:
-                scan_list.append(file_info[1].path)
-            # Add entry to the file list.
-            files[file_info[0]] = file_info[1]
-    # Return to the root directory.
-    ftp.cwd(sync_info.remote_root)
+            # Add whitelist entry to the file list, and to the scan list if it's a directory.
+            add_entry(file_info, entry.unique, scan_list, check_list)
+
+    # Scan the directory tree one level at a time, with every directory on
+    # the same level being scanned at the same time over separate connections.
+    while scan_list or check_list:
+        next_level: list = []
+        next_check: list = []
+        for d, dir_files in pool.map(lambda d: list_remote_dir(pool, d), scan_list):
+            if v: print(f"Listed directory: {d}")
+            for f in dir_files:
+                file_info = generate_fileinfo_for_remote_files(root_len, blacklist, d, f, v)
+                if file_info:
+                    add_entry(file_info, f.unique, next_level, next_check)
+        for d, found_entry in zip(check_list, pool.map(lambda d: find_remote_entry(pool, d), check_list)):
+            # Removing the directory would have changed its parent's modified date, so
+            # the lookup failed for some other reason. List it instead of dropping the
+            # cached files, which would get them deleted locally.
+            if found_entry is None:
+                rel_path: str = d[root_len:]
+                files.add(rel_path, *previous.row(previous.idx[rel_path]))
+                next_level.append(d)
+                continue
+            parent_path, entry = found_entry
+            file_info = generate_fileinfo_for_remote_files(root_len, blacklist, parent_path, entry, v)
+            if file_info:
+                add_entry(file_info, entry.unique, next_level, next_check)
+        scan_list, check_list = next_level, next_check
 
     return files
 
-def get_local_files(sync_info: SyncInfo, v: bool = False)->dict[str, FileInfo]:
+def scan_local_dir(d: str, root_len: int, blacklist: frozenset, is_win: bool)->list:
+    """
+    Scans a single local directory.
+
+    Arguments:
+        d: A string with the path of the directory to scan.
+        root_len: The length of the local root, used to find the relative paths.
+        blacklist: A frozenset with the relative paths to skip.
+        is_win: A boolean which is True on Windows, where the paths use backslashes.
+
+    Returns:
+        A list of tuples in the format yielded by walk_local_tree.
+    """
+    entries: list = []
+    # Remove the local root and backslashes (for Windows) so the paths match the remote ones.
+    # Names can't contain slashes, so this only needs doing once for the directory.
+    rel_dir: str = d[root_len:]
+    if is_win: rel_dir = rel_dir.replace('\\', '/')
+    # Get files in the directory being scanned.
+    with os.scandir(d) as results:
+        for entry in results:
+            rel_path: str = f"{rel_dir}/{entry.name}"
+            # Ignore blacklisted paths.
+            if rel_path in blacklist:
+                continue
+
+            # We only want files and directories. The stat result is cached by the
+            # DirEntry and needed for the file info anyway, so the type comes from
+            # it instead of is_dir and is_file, which can each cost a system call
+            # on file systems that don't report the type with the listing.
+            mode: int = entry.stat(follow_symlinks=False).st_mode
+            is_dir: bool = S_ISDIR(mode)
+            if not is_dir and not S_ISREG(mode):
+                continue
+            entries.append((rel_path, entry, is_dir))
+    return entries
+
+def walk_local_tree(scan_list: list, root_len: int, blacklist: frozenset, v: bool = False):
+    """
+    Walks through the local directories, yielding every file and directory found.
+    The tree is scanned one level at a time, with the directories on each level
+    being scanned at the same time by LOCAL_SCAN_THREADS threads.
+
+    Arguments:
+        scan_list: A list with the paths of the directories to start from.
+        root_len: The length of the local root, used to find the relative paths.
+        blacklist: A frozenset with the relative paths to skip.
+        v: A boolean indicating whether or not to display additional information.
+
+    Yields:
+        A tuple where the first element is the path relative to the root directory,
+        the second is the os.DirEntry and the third is a boolean which is True for
+        directories. Blacklisted entries and anything that isn't a normal file or
+        directory (including symbolic links) are skipped.
+    """
+    is_win: bool = is_windows()
+    with ThreadPoolExecutor(max_workers=LOCAL_SCAN_THREADS) as executor:
+        while scan_list:
+            next_level: list = []
+            for d, entries in zip(scan_list, executor.map(lambda d: scan_local_dir(d, root_len, blacklist, is_win), scan_list)):
+                if v: print(f"Scanned directory: {d}")
+                for rel_path, entry, is_dir in entries:
+                    # Add directories to the next level.
+                    if is_dir: next_level.append(entry.path)
+                    yield (rel_path, entry, is_dir)
+            scan_list = next_level
+
+def get_local_files(sync_info: SyncInfo, v: bool = False)->FileTable:
     """
     Gets a list of all local files that exist in whitelisted paths.
 
     Arguments:
         sync_info: A SyncInfo object
-        is_win: A boolean indicating whether or not the program is running on a Windows machine.
         v: A boolean indicating whether or not to display additional information.
 
     Returns:
-        dict[str, FileInfo] A dictionary with the file path as the key and a FileInfo object
-        as the entry.
+        FileTable A table of the files keyed by the path relative to the root directory.
     """
-    files: dict[str, FileInfo] = {}
+    files: FileTable = FileTable()
     scan_list: list = [sync_info.local_root]
     print("Getting local files...")
 
@@ -325,40 +1267,22 @@ def get_local_files(sync_info: SyncInfo, v: bool = False)->dict[str, FileInfo]:
         # Only add whitelist entries if they exist.
         for d in sync_info.whitelist:
             path = sync_info.local_root + d
-            if os.path.exists(path):
-                # Check if the path leads to a directory.
-                is_dir = os.path.isdir(path)
-                files[d] = FileInfo(d, os.path.getmtime(path), os.path.getsize(path), is_dir)
-                # If the path is a directory, add it to the scan list.
-                if is_dir: scan_list.append(path)
-
-    for d in scan_list:
-        if v: print(f"Changing directory to: {d}")
-        # Get files in the directory being scanned.
-        results = os.scandir(d)
-
-        for entry in results:
-            # Remove the local root and backslashes (for Windows) so the path matches the remote one.
-            rel_path = entry.path.replace(sync_info.local_root, '').replace('\\', '/')
-            # Ignore blacklisted paths.
-            if rel_path in sync_info.blacklist:
-                continue
-
-            # We only want files and directories.
-            if not entry.is_file() and not entry.is_dir():
+            try:
+                stat = os.stat(path)
+            except OSError:
                 continue
-
-            if v: print(f"Found: {rel_path}")
-            # Add directories to the scan list.
-            is_dir: bool = False
-            if entry.is_dir():
-                is_dir = True
-                scan_list.append(entry.path)
-
-            # Get the file info.
-            stat = entry.stat(follow_symlinks=False)
-            # Add the file info to the file list.
-            files[rel_path] = FileInfo(entry.path, stat.st_mtime, stat.st_size, is_dir)
+            # Check if the path leads to a directory.
+            is_dir = S_ISDIR(stat.st_mode)
+            files.add(d, path, stat.st_mtime, stat.st_size, is_dir)
+            # If the path is a directory, add it to the scan list.
+            if is_dir: scan_list.append(path)
+
+    for rel_path, entry, is_dir in walk_local_tree(scan_list, len(sync_info.local_root), sync_info.blacklist, v):
+        if v: print(f"Found: {rel_path}")
+        # Get the file info, already cached by walk_local_tree.
+        stat = entry.stat(follow_symlinks=False)
+        # Add the file info to the file list.
+        files.add(rel_path, entry.path, stat.st_mtime, stat.st_size, is_dir)
     return files
 
 def sync(args)->None:
@@ -367,12 +1291,32 @@ def sync(args)->None:
     info = load_connection_settings(args)
     con_info: ConnectionInfo = info[0]
     sync_info: SyncInfo = info[1]
-    ftp: ftplib.FTP = connect(con_info)
+    pool = ConnectionPool(connect(con_info), con_info, max(1, args.parallel))
     summary_path = f'./summary-{con_info.host}.txt' if args.separate_summary else './summary.txt';
 
-    # Get the remote and local files to be compared.
-    r_files: dict[str, FileInfo] = get_remote_files(ftp, sync_info, v)
-    l_files: dict[str, FileInfo] = get_local_files(sync_info, v)
+    # Get the remote and local files to be compared, reusing the lists
+    # from a recent run if the root directories haven't changed since.
+    use_cache: bool = not args.no_cache and not args.refresh
+    r_cache_path = get_cache_path(f"remote:{con_info.user}@{con_info.host}:{con_info.port}{sync_info.remote_root}", sync_info)
+    l_cache_path = get_cache_path(f"local:{sync_info.local_root}", sync_info)
+    r_root_m_date = None if args.no_cache else get_remote_m_date(pool, sync_info.remote_root)
+    l_root_m_date = None if args.no_cache else get_local_m_date(sync_info.local_root or '.')
+
+    r_files: FileTable|None = load_file_cache(r_cache_path, args.cache_ttl, r_root_m_date) if use_cache else None
+    if r_files is None:
+        # Reuse the directories that haven't changed from the last remote file list.
+        previous: FileTable|None = None
+        if args.dir_mtime and use_cache and 'MLST' in pool.features:
+            previous = load_file_cache(r_cache_path, args.cache_ttl, r_root_m_date, stale=True)
+        r_files = get_remote_files(pool, sync_info, v, previous)
+        save_file_cache(r_cache_path, r_files, r_root_m_date)
+    elif v: print("Using cached remote files")
+
+    l_files: FileTable|None = load_file_cache(l_cache_path, args.cache_ttl, l_root_m_date) if use_cache else None
+    if l_files is None:
+        l_files = get_local_files(sync_info, v)
+        save_file_cache(l_cache_path, l_files, l_root_m_date)
+    elif v: print("Using cached local files")
 
     # These lists contain files belonging to each
     # operation.
@@ -380,71 +1324,72 @@ def sync(args)->None:
     f_to_del: list[str] = []
     d_to_down: list[str] = []
     d_to_del: list[str] = []
-
-    if r_files:
-        # Loop through all the remote files and set any
-        # files that only exist on the remote server or
-        # that are newer than local ones to be downloaded.
-        for key in copy.deepcopy(r_files):
-            # Get the local file data
-            f: SyncInfo = r_files[key]
-            # Get the equivelent local file (if it exists) and remove
-            # it from the local files list.
-            l_file: SyncInfo|None = l_files.pop(key, None)
-            # If the file/directory doesn't exist locally,
-            # add it to the download list.
-            if l_file is None:
-                if f.is_dir:
-                    d_to_down.append(key)
-                else:
-                    f_to_down[key] = f.m_date
-                continue
-
-            # Skip directories beacuse modified date doesn't matter for them.
-            if l_file.is_dir:
-                continue
-
-            # Download if there is a size or last-modified date difference between
-            # the local and remote file.
-            if f.size != l_file.size or f.m_date != l_file.m_date:
-                f_to_down[key] = f.m_date
-            else:
-                r_files.pop(key)
-
-    # Delete any local files that don't exist on the remote server.
-    for f in l_files:
-        # The block checking if files need to be downloaded should
-        # have removed all entries that exist in both locations, so
-        # we can just mark any remaining local entries for deletion
-        if l_files[f].is_dir:
-            d_to_del.append(f)
+    # What the local files will look like once the changes are applied,
+    # saved to the cache at the end so the next run can skip the local
+    # scan. Starts with everything that's already up to date.
+    synced: FileTable = FileTable()
+
+    r_m_dates, r_sizes, r_is_dir = r_files.m_dates, r_files.sizes, r_files.is_dir
+    l_m_dates, l_sizes, l_is_dir = l_files.m_dates, l_files.sizes, l_files.is_dir
+    r_idx: dict[str, int] = r_files.idx
+    l_idx: dict[str, int] = l_files.idx
+
+    # Anything that only exists on the remote server needs to be downloaded.
+    for key in r_idx.keys() - l_idx.keys():
+        i: int = r_idx[key]
+        if r_is_dir[i]:
+            d_to_down.append(key)
+        else:
+            f_to_down[key] = r_m_dates[i]
+
+    # Download files that exist in both places if there is a size or
+    # last-modified date difference. Directories are skipped because
+    # the modified date doesn't matter for them.
+    for key in r_idx.keys() & l_idx.keys():
+        i, j = r_idx[key], l_idx[key]
+        if not l_is_dir[j] and (r_sizes[i] != l_sizes[j] or r_m_dates[i] != l_m_dates[j]):
+            f_to_down[key] = r_m_dates[i]
         else:
-            f_to_del.append(f)
+            synced.add(key, *l_files.row(j))
+
+    # Anything that only exists locally needs to be deleted, except for
+    # partial downloads that will be continued. Ones left from an older
+    # version of the remote file get deleted since they can't be used.
+    # This runs last so f_to_down already has the changed files as well.
+    parts: set[str] = {get_part_path(f, f_to_down[f], r_sizes[r_idx[f]]) for f in f_to_down}
+    for key in l_idx.keys() - r_idx.keys():
+        if key in parts:
+            continue
+        if l_is_dir[l_idx[key]]:
+            d_to_del.append(key)
+        else:
+            f_to_del.append(key)
 
     # No need to continue if no operations need to be done.
     if not f_to_down and not f_to_del and not d_to_down and not d_to_del:
         print("Everything is up to date!")
         write_summary("No changes", summary_path)
+        pool.close()
         sys.exit()
 
-    # Sort all list items by how deep they are in the file structure.
-    # This prevents the program from attempting to download files or
-    # directories into paths that don't exist.
-    f_to_down = dict(sorted(f_to_down.items(), key=lambda x: x[0].count('/')))
-    d_to_down.sort(key=get_dir_level)
-    d_to_del.sort(key=get_dir_level)
+    # Directories are deleted deepest first since they have to be empty.
+    # Files don't need sorting, their directories are all created before
+    # any downloads start.
+    d_to_del.sort(key=get_dir_level, reverse=True)
     f_to_del.sort(key=get_dir_level)
 
     # Output the summary to a text file and ask for confirmation
     # before doing anything with the files.
     down_total: int = len(f_to_down) + len(d_to_down)
-    summary: str = f"Downloads: {down_total}   Deletions: {len(f_to_del) + len(d_to_del)}\n"
-    summary += "--- == Downloads == ---"
-    summary += format_list_to_str(d_to_down)
-    summary += format_list_to_str(f_to_down)
-    summary += "\n--- == Deletions == ---"
-    summary += format_list_to_str(f_to_del)
-    summary += format_list_to_str(d_to_del)
+    summary: str = ''.join((
+        f"Downloads: {down_total}   Deletions: {len(f_to_del) + len(d_to_del)}\n",
+        "--- == Downloads == ---",
+        format_list_to_str(d_to_down),
+        format_list_to_str(f_to_down),
+        "\n--- == Deletions == ---",
+        format_list_to_str(f_to_del),
+        format_list_to_str(d_to_del)
+    ))
 
     write_summary(summary, summary_path)
 
@@ -453,9 +1398,14 @@ def sync(args)->None:
         print("Would you like to apply the changes in summary.txt? (y)es/(n)o")
         if input().lower() not in {'y', 'yes'}:
             print("Sync canceled")
+            pool.close()
             os.remove(summary_path)
             sys.exit()
 
+    # The local files are about to change so the cached list is no longer valid,
+    # a new one is saved once the changes have been applied.
+    if os.path.exists(l_cache_path): os.remove(l_cache_path)
+
     if v: print("Deleting marked files and directories...")
     # Delete marked files...
     for f in f_to_del:
@@ -463,8 +1413,9 @@ def sync(args)->None:
         try:
             os.remove(path)
             if v: print(f"Deleted file: {path}")
-        except:
-            print(f"Error deleting file: {path}")
+        except OSError as e:
+            synced.add(f, *l_files.row(l_idx[f]))
+            print(f"Error deleting file: {path}: {e}")
 
     # Delete marked directories...
     for d in d_to_del:
@@ -472,39 +1423,70 @@ def sync(args)->None:
         try:
             os.rmdir(path)
             if v: print(f"Deleted dir: {path}")
-        except:
-            print(f"Error deleting directory: {path}")
-
-    i: int = 1
-    # Create marked directories...
-    for d in d_to_down:
+        except OSError as e:
+            synced.add(d, *l_files.row(l_idx[d]))
+            print(f"Error deleting directory: {path}: {e}")
+
+    # Create marked directories, only the deepest ones need creating
+    # since os.makedirs creates any missing parents along the way.
+    d_to_down_set: set[str] = set(d_to_down)
+    for d in get_leaf_dirs(d_to_down):
         path = sync_info.local_root + d
         try:
-            os.mkdir(path)
+            os.makedirs(path, exist_ok=True)
             if v: print(f"\rCreated dir: {path}")
-        except:
-            print(f"\rError creating directory: {path}")
+        except OSError as e:
+            print(f"\rError creating directory: {path}: {e}")
+            continue
+        # The directory and every marked parent now exist.
+        while d in d_to_down_set and d not in synced:
+            synced.add(d, sync_info.local_root + d, 0, 0, True)
+            d = d.rsplit('/', 1)[0]
+
+    # Whitelisted files can be inside directories that aren't synced themselves,
+    # those still need to exist locally for the files to be downloaded into.
+    for d in {f.rsplit('/', 1)[0] for f in f_to_down} - r_idx.keys():
+        if not d:
+            continue
+        path = sync_info.local_root + d
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as e:
+            print(f"\rError creating directory: {path}: {e}")
 
-        print(f"\rDownloading file {i} of {down_total}", end='', flush=True)
-        i += 1
+    i: int = len(d_to_down) + 1
+    if d_to_down: print(f"\rDownloading file {i - 1} of {down_total}", end='', flush=True)
 
-    # Download marked files...
-    for f in f_to_down:
+    # Download marked files using the pool so several files
+    # can be transferred at the same time.
+    lock = threading.Lock()
+
+    def download_file(f: str)->None:
+        nonlocal i
         path = sync_info.local_root + f
-        r_path = r_files[f].path
+        r_path = r_files.paths[r_files.idx[f]]
         try:
-            # Download the file
-            with open(path, 'wb') as open_file:
-                ftp.retrbinary(f"RETR {r_path}", open_file.write)
+            resume_download(pool, r_path, path, f_to_down[f], r_files.sizes[r_files.idx[f]])
             # Set the last modified date to match the remote file.
-            os.utime(path, (os.stat(path).st_atime, int(f_to_down[f])))
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, int(f_to_down[f])))
+            with lock:
+                synced.add(f, path, int(f_to_down[f]), stat.st_size, False)
             if v: print(f"\nDownloaded file: {path}")
-        except:
-            print(f"\nError downloading: {r_path}")
-        print(f"\rDownloading file {i} of {down_total}", end='', flush=True)
-        i += 1
-
-    ftp.quit()
+        except ftplib.all_errors as e:
+            print(f"\nError downloading: {r_path}: {e}")
+
+        with lock:
+            print(f"\rDownloading file {i} of {down_total}", end='', flush=True)
+            i += 1
+
+    # Start with the largest files so a big one doesn't end up downloading
+    # on its own connection after everything else has finished.
+    pool.map(download_file, sorted(f_to_down, key=lambda f: r_sizes[r_idx[f]], reverse=True))
+    pool.close()
+    # Failed operations were left out of `synced`, so the next
+    # run will try them again.
+    save_file_cache(l_cache_path, synced, None if args.no_cache else get_local_m_date(sync_info.local_root or '.'))
     if args.delete_summary: os.remove(summary_path)
     print("\nSync finished")
 
@@ -517,6 +1499,11 @@ parser.add_argument('-p', '--password', type=str, default=None, help='overwrite
 parser.add_argument('-nc', '--no-confirm', action='store_true', help='skip the preview changes step')
 parser.add_argument('-ss', '--separate-summary', action='store_true', help='use a separate summary file for each connection')
 parser.add_argument('-ds', '--delete-summary', action='store_true', help='delete the summary file once syncing completes')
+parser.add_argument('-pl', '--parallel', type=int, default=4, help='how many connections to use for listing and downloading files at the same time')
+parser.add_argument('--cache-ttl', type=int, default=300, help='how many seconds to reuse the file lists from a previous run for')
+parser.add_argument('--no-cache', action='store_true', help="don't read or save cached file lists")
+parser.add_argument('--refresh', action='store_true', help='ignore cached file lists and list every file again')
+parser.add_argument('--dir-mtime', action='store_true', help="don't list remote directories again if their modified date hasn't changed since the last run")
 parser.add_argument('-v', '--verbose', action='store_true', help='display more info about what the program is doing')
 parser.set_defaults(func=sync)
 